@@ -2,12 +2,17 @@
 # Generated: 2025-09-12T09:06:03.569557Z
 
 import numpy as np
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 from dataclasses import dataclass
 
 from qiskit import QuantumCircuit, transpile
 from qiskit_aer import AerSimulator
 
+try:
+    from numba import njit
+except ImportError:  # Numba is optional and only needed for executor="analytic-numba".
+    njit = None
+
 def create_random_generator(seed: Optional[int] = None) -> np.random.Generator:
     return np.random.default_rng(seed)
 
@@ -36,34 +41,116 @@ def one_qubit_bb84_circuit(bit: int, alice_basis: int, bob_basis: int) -> Quantu
     qc.measure(0, 0)
     return qc
 
-# Runs a batch of circuits on the local AerSimulator.
-def run_single_shot_batch(circuits: List[QuantumCircuit]) -> List[int]:
-    sim = AerSimulator()
-    tcs = [transpile(c, sim) for c in circuits]
-    res = sim.run(tcs, shots=1).result()
-    bits = []
-    for i in range(len(tcs)):
-        counts = res.get_counts(i)
-        bits.append(int(next(iter(counts))))
-    return bits
+# Shared local simulator instance.
+_AER_SIMULATOR = AerSimulator()
+
+# All 8 (bit, alice_basis, bob_basis) transmission circuits, built once at import.
+# They only use x, h, z and measure, which Aer runs natively, so they are not transpiled for the local simulator.
+_TEMPLATES: Dict[Tuple[int, int, int], QuantumCircuit] = {
+    (bit, alice_basis, bob_basis): one_qubit_bb84_circuit(bit, alice_basis, bob_basis)
+    for bit in (0, 1) for alice_basis in (0, 1) for bob_basis in (0, 1)
+}
+
+# Groups transmissions by their (bit, alice_basis, bob_basis) template.
+# Returns a tuple containing (template_keys, positions), where positions[k] holds the transmission indices using template_keys[k].
+def _group_by_template(alice_bits: np.ndarray, alice_bases: np.ndarray,
+                       bob_bases: np.ndarray) -> Tuple[List[Tuple[int, int, int]], List[np.ndarray]]:
+    codes = (alice_bits << 2) | (alice_bases << 1) | bob_bases
+    unique_codes, inverse, counts = np.unique(codes, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind="stable")
+    positions = np.split(order, np.cumsum(counts)[:-1])
+    keys = [((c >> 2) & 1, (c >> 1) & 1, c & 1) for c in unique_codes.tolist()]
+    return keys, positions
+
+# Measures a batch of transmissions on the shared local AerSimulator.
+# Each distinct template is run once with shots equal to the number of transmissions using it.
+def run_sampled_batch(alice_bits: np.ndarray, alice_bases: np.ndarray, bob_bases: np.ndarray) -> np.ndarray:
+    bob_bits = np.empty(len(alice_bits), dtype=np.int8)
+    for key, pos in zip(*_group_by_template(alice_bits, alice_bases, bob_bases)):
+        memory = _AER_SIMULATOR.run(_TEMPLATES[key], shots=len(pos), memory=True).result().get_memory()
+        # Every template has a single clbit, so each memory entry is exactly '0' or '1'.
+        bob_bits[pos] = np.frombuffer("".join(memory).encode("ascii"), dtype=np.uint8) - ord("0")
+    return bob_bits
+
+# Computes Bob's measurement results analytically for ideal (noiseless) transmissions, without a simulator.
+# Matching bases reproduce Alice's bit; mismatched bases give a uniformly random bit.
+def analytic_bob_bits(rng: np.random.Generator, alice_bits: np.ndarray, alice_bases: np.ndarray,
+                      bob_bases: np.ndarray) -> np.ndarray:
+    random_bits = create_random_bits(rng, len(alice_bits))
+    return np.where(alice_bases == bob_bases, alice_bits, random_bits)
+
+# Fills out_alice/out_bob with n_plus_s ideal sifted bits, drawing raw transmissions until enough bases match.
+# Uses its own SplitMix64 stream seeded by the caller, so it never touches Numba's global RNG state.
+# Each 64-bit draw supplies 21 transmissions of 3 bits: bit 2 is Alice's bit, bits 1 and 0 are Alice's and Bob's bases.
+# Returns the number of raw transmissions used.
+if njit is not None:
+    @njit(cache=True)
+    def _gen_sifted(n_plus_s, seed, out_alice, out_bob):
+        state = np.uint64(seed)
+        raw = 0
+        written = 0
+        while written < n_plus_s:
+            state += np.uint64(0x9E3779B97F4A7C15)
+            z = state
+            z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            z = z ^ (z >> np.uint64(31))
+            for _ in range(21):
+                if written >= n_plus_s:
+                    break
+                r = int(z & np.uint64(7))
+                z = z >> np.uint64(3)
+                raw += 1
+                if ((r >> 1) & 1) == (r & 1):
+                    out_alice[written] = (r >> 2) & 1
+                    out_bob[written] = (r >> 2) & 1
+                    written += 1
+        return raw
+else:
+    _gen_sifted = None
+
+# Expected fraction of raw transmissions that survive sifting, the headroom added when sizing a batch
+# from it, and the smallest batch worth submitting when topping up a small deficit.
+_SIFT_YIELD = 0.5
+_BATCH_HEADROOM = 1.1
+_MIN_BATCH = 64
+
+# Initial size of the sifted-bit buffers, relative to the n+s bits BB84 needs; they double if outgrown.
+_SIFT_BUFFER_HEADROOM = 1.3
 
 # A data class to hold the results of a BB84 key generation run.
 @dataclass
 class BB84Result:
-    key_bits: List[int]
+    key_bits: np.ndarray
     qber_sample: float
     raw_transmissions: int
     sifted_size_before_sample: int
     sample_indices: List[int]
     kept_indices: List[int]
 
-# Compares bases and returns the sifted key bits and their indices.    
-# Returns atuple containing (alice_sifted_bits, bob_sifted_bits, matching_indices)
+# Compares bases and returns the sifted key bits.
+# Returns a tuple containing (alice_sifted_bits, bob_sifted_bits)
+# Callers that need the matching positions can use np.flatnonzero(alice_bases == bob_bases).
 def sift(alice_bits: np.ndarray, alice_bases: np.ndarray,
-         bob_bases: np.ndarray, bob_bits: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+         bob_bases: np.ndarray, bob_bits: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
     match = (alice_bases == bob_bases)
-    index = np.nonzero(match)[0]
-    return alice_bits[index], bob_bits[index], index
+    return alice_bits[match], bob_bits[match]
+
+# Popcount of every byte value, used when np.bitwise_count (NumPy >= 2.0) is unavailable.
+_BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Below this many bits, packing costs more than it saves and mismatches are counted with a plain XOR and sum.
+_PACKED_COMPARE_MIN = 4096
+
+# Counts the positions where two 0/1 bit arrays differ.
+# Large arrays are packed 8 bits per byte, XORed and popcounted, so the comparison runs over len/8 bytes.
+def _count_mismatches(a_bits: np.ndarray, b_bits: np.ndarray) -> int:
+    if len(a_bits) < _PACKED_COMPARE_MIN:
+        return int(np.bitwise_xor(a_bits, b_bits).sum(dtype=np.int64))
+    diff = np.bitwise_xor(np.packbits(a_bits), np.packbits(b_bits))
+    if hasattr(np, "bitwise_count"):
+        return int(np.bitwise_count(diff).sum(dtype=np.int64))
+    return int(_BYTE_POPCOUNT[diff].sum(dtype=np.int64))
 
 # Samples a subset of sifted bits to verify the Quantum Bit Error Rate (QBER).
 # Returns a tuple containing (kept_bits, qber_value, sample_indices, kept_indices)
@@ -71,14 +158,13 @@ def sample_and_verify(alice_sift: np.ndarray, bob_sift: np.ndarray, sample_size:
     if len(alice_sift) < sample_size:
         raise ValueError(f"Not enough sifted bits to sample: have {len(alice_sift)}, need s={sample_size}")
     sample_index = rng.choice(len(alice_sift), size=sample_size, replace=False)
-    mismatched_bits = int(np.sum(alice_sift[sample_index] != bob_sift[sample_index]))
+    mismatched_bits = _count_mismatches(alice_sift[sample_index], bob_sift[sample_index])
     error_rate = mismatched_bits / sample_size
-    mask = np.ones(len(alice_sift), dtype=bool); mask[sample_index] = False
-    kept_b = bob_sift[mask]
     if error_rate > qber_threshold:
         raise ValueError(f"QBER too high in sample: {error_rate:.3f} > {qber_threshold:.3f}")
-    kept_indices = np.nonzero(mask)[0].tolist()
-    return kept_b.astype(int).tolist(), error_rate, sample_index.tolist(), kept_indices
+    mask = np.ones(len(alice_sift), dtype=bool); mask[sample_index] = False
+    kept_b = bob_sift[mask]
+    return kept_b, error_rate, sample_index.tolist(), np.flatnonzero(mask).tolist()
 
 # Picks the best available IBM backend based on pending jobs.
 def pick_ibm_backend(service, backend_name=None):
@@ -100,57 +186,109 @@ def pick_ibm_backend(service, backend_name=None):
         pass
     return qpus[0]
 
-# Runs a batch of circuits on an IBM Quantum Runtime backend.
-def run_single_shot_batch_runtime(circuits: List[QuantumCircuit], *, runtime_service=None, backend_name=None, shots=1):
-    try:
-        from qiskit_ibm_runtime import SamplerV2 as Sampler, Session, QiskitRuntimeService
-    except Exception:
-        from qiskit_ibm_runtime import Sampler, Session, QiskitRuntimeService
-    service = runtime_service or QiskitRuntimeService()
-    backend = pick_ibm_backend(service, backend_name=backend_name)
-    with Session(service=service, backend=backend) as session:
-        sampler = Sampler(mode=session)
-        job = sampler.run(circuits, shots=shots)
-        result = job.result()
-    bits = []
-    for i in range(len(circuits)):
-        pub = result[i]
+# Holds an IBM Quantum Runtime service, backend and open Session so consecutive batches reuse them.
+# The backend is picked and the BB84 templates are transpiled for it once, when the runner is created;
+# pass the same runner to several BB84 calls to avoid repeating the backend status queries.
+class BB84Runner:
+    def __init__(self, runtime_service=None, backend_name=None):
         try:
-            counts = pub.data.meas.get_counts()
+            from qiskit_ibm_runtime import SamplerV2 as Sampler, Session, QiskitRuntimeService
         except Exception:
-            counts = pub.join_data().get_counts()
-        bits.append(int(next(iter(counts))[-1]))
-    return bits
+            from qiskit_ibm_runtime import Sampler, Session, QiskitRuntimeService
+        self.service = runtime_service or QiskitRuntimeService()
+        self.backend = pick_ibm_backend(self.service, backend_name=backend_name)
+        self._transpiled_templates = {key: transpile(tmpl, backend=self.backend) for key, tmpl in _TEMPLATES.items()}
+        self.session = Session(service=self.service, backend=self.backend)
+        self.sampler = Sampler(mode=self.session)
+
+    # Measures a batch of transmissions in the open session.
+    # All distinct templates are submitted together in one sampler job, one PUB per template with shots equal to its group size.
+    def run(self, alice_bits: np.ndarray, alice_bases: np.ndarray, bob_bases: np.ndarray) -> np.ndarray:
+        keys, positions = _group_by_template(alice_bits, alice_bases, bob_bases)
+        job = self.sampler.run([(self._transpiled_templates[key], None, len(pos)) for key, pos in zip(keys, positions)])
+        result = job.result()
+        bob_bits = np.empty(len(alice_bits), dtype=np.int8)
+        for i, pos in enumerate(positions):
+            pub = result[i]
+            try:
+                bit_array = pub.data.meas
+            except Exception:
+                bit_array = pub.join_data()
+            # BitArray stores shots as rows of big-endian packed bytes; clbit 0 is the low bit of the last byte.
+            bob_bits[pos] = bit_array.array[:, -1] & 1
+        return bob_bits
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self) -> "BB84Runner":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Measures a single batch of transmissions on an IBM Quantum Runtime backend, using a one-off BB84Runner.
+def run_sampled_batch_runtime(alice_bits: np.ndarray, alice_bases: np.ndarray, bob_bases: np.ndarray, *,
+                              runtime_service=None, backend_name=None) -> np.ndarray:
+    with BB84Runner(runtime_service=runtime_service, backend_name=backend_name) as runner:
+        return runner.run(alice_bits, alice_bases, bob_bases)
 
 #  Implements the BB84 Quantum Key Distribution protocol to generate a secure key.
 def BB84(n: int, s: int, *, seed: Optional[int] = None, batch_size: int = 1024,
          executor: str = "aer", runtime_service=None, backend_name: Optional[str] = None,
-         qber_threshold: float = 0.02) -> BB84Result:
+         qber_threshold: float = 0.02, runner: Optional[BB84Runner] = None) -> BB84Result:
     if n <= 0 or s < 0:
         raise ValueError("n must be >0 and s >=0")
     random_generator = create_random_generator(seed)
-    alice_sift_all, bob_sift_all = [], []
-    raw_total = 0
-    while True:
-        m = batch_size
-        alice_bits  = create_random_bits(random_generator, m)
-        alice_bases = create_random_bases(random_generator, m)
-        bob_bases = create_random_bases(random_generator, m)
-        circuits = [one_qubit_bb84_circuit(int(alice_bits[i]), int(alice_bases[i]), int(bob_bases[i])) for i in range(m)]
-        if executor.lower() == "aer":
-            bob_bits = np.array(run_single_shot_batch(circuits), dtype=np.int8)
-        elif executor.lower() == "runtime":
-            bob_bits = np.array(run_single_shot_batch_runtime(circuits, runtime_service=runtime_service, backend_name=backend_name, shots=1), dtype=np.int8)
-        else:
-            raise ValueError("executor must be 'aer' or 'runtime'")
-        raw_total += m
-        alice_sift, bob_sift, _ = sift(alice_bits, alice_bases, bob_bases, bob_bits)
-        if len(alice_sift):
-            alice_sift_all.append(alice_sift); bob_sift_all.append(bob_sift)
-        if sum(len(x) for x in alice_sift_all) >= n + s:
-            break
-    alice_sift_cat = np.concatenate(alice_sift_all) if alice_sift_all else np.array([], dtype=np.int8)
-    bob_sift_cat = np.concatenate(bob_sift_all) if bob_sift_all else np.array([], dtype=np.int8)
+    if executor.lower() == "analytic-numba":
+        # Compiled fast path: draw, sift and accumulate in one pass with no per-round temporaries.
+        # Its bit stream differs from the NumPy "analytic" path, so the same seed gives a different (but reproducible) key.
+        if _gen_sifted is None:
+            raise RuntimeError("executor 'analytic-numba' requires numba to be installed")
+        alice_sift_cat = np.empty(n + s, dtype=np.int8)
+        bob_sift_cat = np.empty(n + s, dtype=np.int8)
+        kernel_seed = int(random_generator.integers(0, 2**63))
+        raw_total = int(_gen_sifted(n + s, kernel_seed, alice_sift_cat, bob_sift_cat))
+    else:
+        capacity = int((n + s) * _SIFT_BUFFER_HEADROOM)
+        alice_sift_cat = np.empty(capacity, dtype=np.int8)
+        bob_sift_cat = np.empty(capacity, dtype=np.int8)
+        raw_total = 0
+        sifted_total = 0
+        owns_runner = executor.lower() == "runtime" and runner is None
+        if owns_runner:
+            runner = BB84Runner(runtime_service=runtime_service, backend_name=backend_name)
+        try:
+            while True:
+                need = (n + s) - sifted_total
+                m = min(batch_size, max(_MIN_BATCH, int(need / _SIFT_YIELD * _BATCH_HEADROOM)))
+                # One RNG call per round; the rows are views into the same buffer.
+                alice_bits, alice_bases, bob_bases = random_generator.integers(0, 2, size=(3, m), dtype=np.int8)
+                if executor.lower() == "analytic":
+                    bob_bits = analytic_bob_bits(random_generator, alice_bits, alice_bases, bob_bases)
+                elif executor.lower() == "aer":
+                    bob_bits = run_sampled_batch(alice_bits, alice_bases, bob_bases)
+                elif executor.lower() == "runtime":
+                    bob_bits = runner.run(alice_bits, alice_bases, bob_bases)
+                else:
+                    raise ValueError("executor must be 'aer', 'runtime', 'analytic' or 'analytic-numba'")
+                raw_total += m
+                alice_sift, bob_sift = sift(alice_bits, alice_bases, bob_bases, bob_bits)
+                k = len(alice_sift)
+                if sifted_total + k > len(alice_sift_cat):
+                    capacity = max(2 * len(alice_sift_cat), sifted_total + k)
+                    alice_sift_cat = np.resize(alice_sift_cat, capacity)
+                    bob_sift_cat = np.resize(bob_sift_cat, capacity)
+                alice_sift_cat[sifted_total:sifted_total + k] = alice_sift
+                bob_sift_cat[sifted_total:sifted_total + k] = bob_sift
+                sifted_total += k
+                if sifted_total >= n + s:
+                    break
+        finally:
+            if owns_runner:
+                runner.close()
+        alice_sift_cat = alice_sift_cat[:sifted_total]
+        bob_sift_cat = bob_sift_cat[:sifted_total]
     kept_bits, qber, sample_idx, kept_idx = sample_and_verify(alice_sift_cat, bob_sift_cat, s, random_generator, qber_threshold=qber_threshold)
     if len(kept_bits) < n:
         raise RuntimeError(f"After sampling, not enough bits remain: have {len(kept_bits)}, need {n}")
@@ -169,5 +307,5 @@ if __name__ == "__main__":
     print("Raw transmissions:", res.raw_transmissions)
     print("Sifted (before sampling):", res.sifted_size_before_sample)
     print("Sample QBER:", res.qber_sample)
-    print("First 32 key bits:", ''.join(map(str, res.key_bits[:32])), "...")
+    print("First 32 key bits:", ''.join(res.key_bits[:32].astype(str)), "...")
     print("Key length:", len(res.key_bits))